@@ -2,6 +2,11 @@ import logging
 import sqlite3
 import os
 import json, re
+import heapq
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Dict, List, Tuple
 
@@ -35,6 +40,24 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 _gemini_client = None
 MODEL_ID = "gemini-2.5-flash"  # быстрый вариант; при 404 падаем на pro
 
+_RECEIPT_PROMPT = """
+Извлеки все позиции из ресторанного чека и верни строго JSON:
+{
+  "items": [
+    {"name": "string", "price": number, "quantity": number}
+  ]
+}
+Правила:
+- Цена только числом (без валюты)
+- Учитывай множители (x2, ×3 и т.п.) в quantity
+- Включай блюда, напитки, сервис/чаевые
+- Никаких комментариев, только JSON
+"""
+
+# LRU распознанных чеков: blake2b(фото) -> ((name, price, qty), ...)
+_RECEIPT_CACHE_SIZE = 256
+_receipt_cache: "OrderedDict[bytes, tuple]" = OrderedDict()
+
 def get_gemini_client():
     global _gemini_client
     if _gemini_client is not None:
@@ -47,40 +70,61 @@ def get_gemini_client():
     )
     return _gemini_client
 
-def build_resto_ui(conn, session_id: int, current_user_id: int):
+def load_resto_state(c, session_id: int):
+    """
+    Загружает из БД всё, что нужно для отрисовки ресторанной сессии.
+    Ожидает курсор из db.cursor() — вызывается внутри уже открытой транзакции.
+    Возвращает dict:
+    - items: [(item_id, name, price, qty), ...] в порядке id
+    - choices: {item_id: set(user_id)} — кто выбрал позицию
+    - creator_id: создатель сессии (для прав на закрытие), None — если сессии нет
+    Результат кешируется в context.chat_data[session_id], чтобы нажатия
+    на кнопки не перечитывали всю сессию.
+    """
+    # Создатель, все позиции и выбравшие — одним запросом.
+    # FROM resto_sessions + LEFT JOIN: строка с creator_id есть, даже если позиций ещё нет
+    c.execute("""
+        SELECT rs.creator_id, ri.id, ri.item_name, ri.price, ri.quantity, rc.user_id
+        FROM resto_sessions rs
+        LEFT JOIN resto_items ri ON ri.session_id = rs.id
+        LEFT JOIN resto_choices rc ON rc.item_id = ri.id
+        WHERE rs.id = ?
+        ORDER BY ri.id
+    """, (session_id,))
+    creator_id = None
+    items = []
+    choices = {}
+    for creator_id, item_id, name, price, qty, uid in c.fetchall():
+        if item_id is None:
+            continue
+        if item_id not in choices:
+            items.append((item_id, name, price, qty))
+            choices[item_id] = set()
+        if uid is not None:
+            choices[item_id].add(uid)
+
+    return {"items": items, "choices": choices, "creator_id": creator_id}
+
+def build_resto_ui(state: dict, current_user_id: int):
     """
-    Собирает текст и клавиатуру для ресторанной сессии.
+    Собирает текст и клавиатуру для ресторанной сессии (из load_resto_state).
     - Одна кнопка на позицию: '🍽 Название [N]' (N — сколько человек выбрали)
     - Если текущий пользователь выбрал позицию — добавляется '✅'
     - Внизу добавляется кнопка '🧾 Закрыть счёт'
+    БД не трогает — только Python.
     Возвращает: (text, InlineKeyboardMarkup, creator_id)
     """
-    c = conn.cursor()
-
     # Текст шапки
-    msg = "✅ Чек обработан!\n\nВыберите свои позиции (нажмите на нужные, повторное нажатие снимает выбор):\n\n"
-
-    # Все позиции
-    c.execute(
-        "SELECT id, item_name, price, quantity FROM resto_items WHERE session_id = ? ORDER BY id",
-        (session_id,)
-    )
-    items_rows = c.fetchall()
-
-    # Создатель сессии (для прав на закрытие)
-    c.execute("SELECT creator_id FROM resto_sessions WHERE id = ?", (session_id,))
-    row = c.fetchone()
-    creator_id = row[0] if row else None
+    parts = ["✅ Чек обработан!\n\nВыберите свои позиции (нажмите на нужные, повторное нажатие снимает выбор):\n\n"]
 
     keyboard = []
 
-    for (item_id, name, price, qty) in items_rows:
+    for (item_id, name, price, qty) in state["items"]:
         total = price * qty
         qty_text = f" x{qty}" if qty > 1 else ""
 
         # кто выбрал эту позицию
-        c.execute("SELECT user_id FROM resto_choices WHERE item_id = ?", (item_id,))
-        choosers = [r[0] for r in c.fetchall()]
+        choosers = state["choices"][item_id]
         count = len(choosers)
         picked_by_me = current_user_id in choosers
 
@@ -92,7 +136,7 @@ def build_resto_ui(conn, session_id: int, current_user_id: int):
             btn_text += " ✅"
 
         # строка текста для позиции
-        msg += f"• {name}{qty_text} — {total:,.0f} сум\n"
+        parts.append(f"• {name}{qty_text} — {total:,.0f} сум\n")
 
         # одна кнопка на позицию
         keyboard.append([
@@ -102,96 +146,137 @@ def build_resto_ui(conn, session_id: int, current_user_id: int):
     # Кнопка «Закрыть счёт» — видна всем; проверка прав будет в хендлере
     keyboard.append([InlineKeyboardButton("🧾 Закрыть счёт", callback_data="close_resto")])
 
-    return msg, InlineKeyboardMarkup(keyboard), creator_id
+    return "".join(parts), InlineKeyboardMarkup(keyboard), state["creator_id"]
 
 
 # ---------------------- БД ----------------------
 class Database:
     def __init__(self, db_name="split_bot.db"):
         self.db_name = db_name
+        # одно долгоживущее соединение на весь процесс; доступ сериализуем локом
+        self._conn = sqlite3.connect(db_name, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.execute("PRAGMA temp_store=MEMORY")
         self.init_db()
 
-    def get_connection(self):
-        return sqlite3.connect(self.db_name)
+    @contextmanager
+    def cursor(self):
+        """
+        Курсор в рамках одной транзакции: COMMIT при выходе, ROLLBACK при ошибке
+        (это делает сам `with conn:` из sqlite3).
+        Внутри блока нельзя делать await — лок держится до выхода из with.
+        """
+        with self._lock, self._conn:
+            c = self._conn.cursor()
+            c.execute("BEGIN")
+            try:
+                yield c
+            finally:
+                c.close()
 
     def init_db(self):
-        conn = self.get_connection()
-        c = conn.cursor()
-
-        # Общий счёт (/newbill)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS bills (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                creator_id INTEGER NOT NULL,
-                creator_username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                closed_at TIMESTAMP,
-                status TEXT DEFAULT 'open'
-            )
-        """)
-
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS bill_participants (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bill_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                UNIQUE (bill_id, user_id),
-                FOREIGN KEY (bill_id) REFERENCES bills(id)
-            )
-        """)
-
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                bill_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                description TEXT,
-                amount REAL NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (bill_id) REFERENCES bills(id)
-            )
-        """)
-
-        # Ресторанный режим (/resto)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS resto_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER NOT NULL,
-                creator_id INTEGER NOT NULL,
-                creator_username TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                closed_at TIMESTAMP,
-                status TEXT DEFAULT 'open'
-            )
-        """)
-
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS resto_items (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id INTEGER NOT NULL,
-                item_name TEXT NOT NULL,
-                price REAL NOT NULL,
-                quantity INTEGER DEFAULT 1,
-                is_shared BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (session_id) REFERENCES resto_sessions(id)
-            )
-        """)
-
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS resto_choices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                item_id INTEGER NOT NULL,
-                user_id INTEGER NOT NULL,
-                username TEXT,
-                FOREIGN KEY (item_id) REFERENCES resto_items(id)
-            )
-        """)
-
-        conn.commit()
-        conn.close()
+        with self.cursor() as c:
+            # Общий счёт (/newbill)
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS bills (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    creator_id INTEGER NOT NULL,
+                    creator_username TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    closed_at TIMESTAMP,
+                    status TEXT DEFAULT 'open'
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS bill_participants (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    bill_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    UNIQUE (bill_id, user_id),
+                    FOREIGN KEY (bill_id) REFERENCES bills(id)
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS expenses (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    bill_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    description TEXT,
+                    amount REAL NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (bill_id) REFERENCES bills(id)
+                )
+            """)
+
+            # Ресторанный режим (/resto)
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS resto_sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    creator_id INTEGER NOT NULL,
+                    creator_username TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    closed_at TIMESTAMP,
+                    status TEXT DEFAULT 'open'
+                )
+            """)
+
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS resto_items (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id INTEGER NOT NULL,
+                    item_name TEXT NOT NULL,
+                    price REAL NOT NULL,
+                    quantity INTEGER DEFAULT 1,
+                    is_shared BOOLEAN DEFAULT FALSE,
+                    FOREIGN KEY (session_id) REFERENCES resto_sessions(id)
+                )
+            """)
+
+            # Старая схема resto_choices (с синтетическим id) — переносим в WITHOUT ROWID
+            c.execute("PRAGMA table_info(resto_choices)")
+            migrate_choices = any(col[1] == "id" for col in c.fetchall())
+            if migrate_choices:
+                c.execute("ALTER TABLE resto_choices RENAME TO resto_choices_old")
+
+            # Выбор блюд: все обращения идут по (item_id, user_id) — это и есть PK
+            c.execute("""
+                CREATE TABLE IF NOT EXISTS resto_choices (
+                    item_id INTEGER NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    PRIMARY KEY (item_id, user_id),
+                    FOREIGN KEY (item_id) REFERENCES resto_items(id)
+                ) WITHOUT ROWID
+            """)
+
+            if migrate_choices:
+                c.execute("""
+                    INSERT OR IGNORE INTO resto_choices (item_id, user_id, username)
+                    SELECT item_id, user_id, username FROM resto_choices_old
+                    WHERE item_id IN (SELECT id FROM resto_items)
+                    ORDER BY id
+                """)
+                c.execute("DROP TABLE resto_choices_old")
+
+            # Индексы под горячие выборки (chat_id + status, внешние ключи)
+            c.execute("CREATE INDEX IF NOT EXISTS idx_bills_chat_status ON bills(chat_id, status)")
+            # bill_participants.bill_id покрывает автоиндекс UNIQUE (bill_id, user_id)
+            c.execute("CREATE INDEX IF NOT EXISTS idx_expenses_bill ON expenses(bill_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_resto_sessions_chat_status ON resto_sessions(chat_id, status)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_resto_items_session ON resto_items(session_id)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_bills_chat_created ON bills(chat_id, created_at DESC)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_resto_sessions_chat_created ON resto_sessions(chat_id, created_at DESC)")
+            # resto_choices отдельных индексов не требует: PK (item_id, user_id) покрывает и item_id
 
 db = Database()
 
@@ -199,37 +284,39 @@ db = Database()
 # ---------------------- ХЕЛПЕРЫ ----------------------
 def minimize_transactions(balances: Dict[int, float]) -> List[Tuple[int, int, float]]:
     """
-    Жадный алгоритм минимизации количества переводов.
+    Жадный алгоритм минимизации количества переводов:
+    крупнейший должник платит крупнейшему кредитору, остаток возвращается в кучу.
     Возвращает список (from_user_id, to_user_id, amount)
     """
     txs = []
-    debtors = [(uid, -amt) for uid, amt in balances.items() if amt < -0.01]
-    creditors = [(uid, amt) for uid, amt in balances.items() if amt > 0.01]
-
-    debtors.sort(key=lambda x: x[1], reverse=True)
-    creditors.sort(key=lambda x: x[1], reverse=True)
-
-    i = j = 0
-    while i < len(debtors) and j < len(creditors):
-        duid, debt = debtors[i]
-        cuid, cred = creditors[j]
+    # heapq — min-куча, поэтому храним суммы со знаком минус: сверху самый крупный
+    debt_heap = [(amt, uid) for uid, amt in balances.items() if amt < -0.01]
+    cred_heap = [(-amt, uid) for uid, amt in balances.items() if amt > 0.01]
+    heapq.heapify(debt_heap)
+    heapq.heapify(cred_heap)
+
+    while debt_heap and cred_heap:
+        neg_debt, duid = heapq.heappop(debt_heap)
+        neg_cred, cuid = heapq.heappop(cred_heap)
+        debt, cred = -neg_debt, -neg_cred
         amount = min(debt, cred)
         txs.append((duid, cuid, amount))
-        debt -= amount
-        cred -= amount
-        if debt <= 0.01:
-            i += 1
-        else:
-            debtors[i] = (duid, debt)
-        if cred <= 0.01:
-            j += 1
-        else:
-            creditors[j] = (cuid, cred)
+        if debt - amount > 0.01:
+            heapq.heappush(debt_heap, (amount - debt, duid))
+        if cred - amount > 0.01:
+            heapq.heappush(cred_heap, (amount - cred, cuid))
     return txs
 
+# запятые-разделители разрядов в сумме трат ("50,000") — удаляются одним str.translate.
+# Пробельных символов в сумме не бывает: rsplit() в handle_expense уже режет по ним
+_AMOUNT_STRIP = str.maketrans("", "", ",")
+
+_JSON_FENCE_RE = re.compile(r"```json\s*(\{[\s\S]*?\})\s*```", re.IGNORECASE)
+_JSON_OBJ_RE = re.compile(r"(\{[\s\S]*\})")
+
 def extract_json(text: str):
     # ```json ... ```
-    m = re.search(r"```json\s*(\{[\s\S]*?\})\s*```", text, re.IGNORECASE)
+    m = _JSON_FENCE_RE.search(text)
     if m:
         return json.loads(m.group(1))
     # целиком
@@ -237,7 +324,7 @@ def extract_json(text: str):
         return json.loads(text)
     except:
         # первая {...}
-        m = re.search(r"(\{[\s\S]*\})", text)
+        m = _JSON_OBJ_RE.search(text)
         if m:
             return json.loads(m.group(1))
     raise ValueError("LLM did not return valid JSON")
@@ -260,23 +347,20 @@ async def newbill(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
 
-    conn = db.get_connection()
-    c = conn.cursor()
+    with db.cursor() as c:
+        c.execute("SELECT EXISTS(SELECT 1 FROM bills WHERE chat_id = ? AND status = 'open')", (chat_id,))
+        already_open = bool(c.fetchone()[0])
+        if not already_open:
+            c.execute(
+                "INSERT INTO bills (chat_id, creator_id, creator_username) VALUES (?, ?, ?)",
+                (chat_id, user_id, username)
+            )
+            bill_id = c.lastrowid
 
-    c.execute("SELECT id FROM bills WHERE chat_id = ? AND status = 'open'", (chat_id,))
-    if c.fetchone():
+    if already_open:
         await update.message.reply_text("❌ Уже есть открытый счет. Закройте его командой /closebill")
-        conn.close()
         return
 
-    c.execute(
-        "INSERT INTO bills (chat_id, creator_id, creator_username) VALUES (?, ?, ?)",
-        (chat_id, user_id, username)
-    )
-    bill_id = c.lastrowid
-    conn.commit()
-    conn.close()
-
     keyboard = [[InlineKeyboardButton("✅ Присоединиться к счету", callback_data=f"join_bill_{bill_id}")]]
     await update.message.reply_text(
         f"💰 Новый счет создан!\nСоздатель: @{username}\n\n"
@@ -292,35 +376,35 @@ async def join_bill_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = q.from_user.id
     username = q.from_user.username or q.from_user.first_name
 
-    conn = db.get_connection()
-    c = conn.cursor()
+    with db.cursor() as c:
+        c.execute("SELECT status FROM bills WHERE id = ?", (bill_id,))
+        r = c.fetchone()
+        is_open = r is not None and r[0] == "open"
+        joined = False
+        if is_open:
+            # повторное нажатие — не ошибка: ON CONFLICT просто ничего не вставит
+            c.execute(
+                "INSERT INTO bill_participants (bill_id, user_id, username) VALUES (?, ?, ?) "
+                "ON CONFLICT(bill_id, user_id) DO NOTHING",
+                (bill_id, user_id, username)
+            )
+            joined = c.rowcount > 0
+        if joined:
+            c.execute("SELECT username FROM bill_participants WHERE bill_id = ?", (bill_id,))
+            parts = [row[0] for row in c.fetchall()]
 
-    c.execute("SELECT status FROM bills WHERE id = ?", (bill_id,))
-    r = c.fetchone()
-    if not r or r[0] != "open":
+    if not is_open:
         await q.edit_message_text("❌ Этот счет уже закрыт.")
-        conn.close()
         return
-
-    try:
-        c.execute(
-            "INSERT INTO bill_participants (bill_id, user_id, username) VALUES (?, ?, ?)",
-            (bill_id, user_id, username)
-        )
-        conn.commit()
-
-        c.execute("SELECT username FROM bill_participants WHERE bill_id = ?", (bill_id,))
-        parts = [row[0] for row in c.fetchall()]
-
-        keyboard = [[InlineKeyboardButton("✅ Присоединиться к счету", callback_data=f"join_bill_{bill_id}")]]
-        await q.edit_message_text(
-            q.message.text + f"\n\nУчастники ({len(parts)}): " + ", ".join([f"@{p}" for p in parts]),
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-    except sqlite3.IntegrityError:
+    if not joined:
         await q.answer("Вы уже в этом счете!", show_alert=True)
-    finally:
-        conn.close()
+        return
+
+    keyboard = [[InlineKeyboardButton("✅ Присоединиться к счету", callback_data=f"join_bill_{bill_id}")]]
+    await q.edit_message_text(
+        q.message.text + f"\n\nУчастники ({len(parts)}): " + ", ".join([f"@{p}" for p in parts]),
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
 async def handle_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -328,39 +412,35 @@ async def handle_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or update.effective_user.first_name
     text = update.message.text.strip()
 
-    conn = db.get_connection()
-    c = conn.cursor()
-
-    c.execute("SELECT id FROM bills WHERE chat_id = ? AND status = 'open'", (chat_id,))
-    r = c.fetchone()
-    if not r:
-        conn.close()
-        return
-    bill_id = r[0]
-
-    c.execute("SELECT id FROM bill_participants WHERE bill_id = ? AND user_id = ?", (bill_id, user_id))
-    if not c.fetchone():
-        conn.close()
-        return
-
+    # сначала разбираем текст — без БД, чтобы не держать лок на «чужих» сообщениях
     parts_ = text.rsplit(maxsplit=1)
     if len(parts_) != 2:
-        conn.close()
         return
     description, amount_str = parts_
 
     try:
-        amount = float(amount_str.replace(" ", "").replace(",", ""))
+        amount = float(amount_str.translate(_AMOUNT_STRIP))
     except ValueError:
-        conn.close()
         return
 
-    c.execute(
-        "INSERT INTO expenses (bill_id, user_id, username, description, amount) VALUES (?, ?, ?, ?, ?)",
-        (bill_id, user_id, username, description, amount)
-    )
-    conn.commit()
-    conn.close()
+    with db.cursor() as c:
+        c.execute("SELECT id FROM bills WHERE chat_id = ? AND status = 'open' LIMIT 1", (chat_id,))
+        r = c.fetchone()
+        if not r:
+            return
+        bill_id = r[0]
+
+        c.execute(
+            "SELECT EXISTS(SELECT 1 FROM bill_participants WHERE bill_id = ? AND user_id = ?)",
+            (bill_id, user_id)
+        )
+        if not c.fetchone()[0]:
+            return
+
+        c.execute(
+            "INSERT INTO expenses (bill_id, user_id, username, description, amount) VALUES (?, ?, ?, ?, ?)",
+            (bill_id, user_id, username, description, amount)
+        )
 
     await update.message.reply_text(f"✅ Добавлено: {description} — {amount:,.0f} сум")
 
@@ -370,22 +450,19 @@ async def resto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = update.effective_user.username or update.effective_user.first_name
 
-    conn = db.get_connection()
-    c = conn.cursor()
+    with db.cursor() as c:
+        c.execute("SELECT EXISTS(SELECT 1 FROM resto_sessions WHERE chat_id = ? AND status = 'open')", (chat_id,))
+        already_open = bool(c.fetchone()[0])
+        if not already_open:
+            c.execute(
+                "INSERT INTO resto_sessions (chat_id, creator_id, creator_username) VALUES (?, ?, ?)",
+                (chat_id, user_id, username)
+            )
 
-    c.execute("SELECT id FROM resto_sessions WHERE chat_id = ? AND status = 'open'", (chat_id,))
-    if c.fetchone():
+    if already_open:
         await update.message.reply_text("❌ Уже есть открытая /resto сессия. Закройте её /closebill")
-        conn.close()
         return
 
-    c.execute(
-        "INSERT INTO resto_sessions (chat_id, creator_id, creator_username) VALUES (?, ?, ?)",
-        (chat_id, user_id, username)
-    )
-    conn.commit()
-    conn.close()
-
     await update.message.reply_text(
         f"🍽 Сессия ресторана создана!\nСоздатель: @{username}\n\n"
         "📸 Отправьте фото чека, чтобы я его обработал."
@@ -395,123 +472,123 @@ async def handle_receipt_photo(update: Update, context: ContextTypes.DEFAULT_TYP
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
 
-    conn = db.get_connection()
-    c = conn.cursor()
+    with db.cursor() as c:
+        c.execute("SELECT id, creator_id FROM resto_sessions WHERE chat_id = ? AND status = 'open' LIMIT 1", (chat_id,))
+        r = c.fetchone()
+        if not r:
+            return
+        session_id, creator_id = r
 
-    c.execute("SELECT id, creator_id FROM resto_sessions WHERE chat_id = ? AND status = 'open'", (chat_id,))
-    r = c.fetchone()
-    if not r:
-        conn.close()
-        return
-    session_id, creator_id = r
+        has_items = False
+        if user_id == creator_id:
+            c.execute("SELECT EXISTS(SELECT 1 FROM resto_items WHERE session_id = ?)", (session_id,))
+            has_items = bool(c.fetchone()[0])
 
     if user_id != creator_id:
         await update.message.reply_text("❌ Только создатель сессии может загружать чек.")
-        conn.close()
         return
 
-    c.execute("SELECT COUNT(*) FROM resto_items WHERE session_id = ?", (session_id,))
-    if c.fetchone()[0] > 0:
+    if has_items:
         await update.message.reply_text("❌ Чек уже загружен.")
-        conn.close()
         return
 
-    conn.close()
     await update.message.reply_text("⏳ Обрабатываю чек...")
 
-    # скачиваем фото
+    # скачиваем фото сразу в память — без временного файла на диске
     photo = update.message.photo[-1]
     file = await context.bot.get_file(photo.file_id)
-    photo_path = f"temp_receipt_{chat_id}.jpg"
-    await file.download_to_drive(photo_path)
 
     try:
-        client = get_gemini_client()
-        with open(photo_path, "rb") as f:
-            image_data = f.read()
-
-        prompt = """
-        Извлеки все позиции из ресторанного чека и верни строго JSON:
-        {
-          "items": [
-            {"name": "string", "price": number, "quantity": number}
-          ]
-        }
-        Правила:
-        - Цена только числом (без валюты)
-        - Учитывай множители (x2, ×3 и т.п.) в quantity
-        - Включай блюда, напитки, сервис/чаевые
-        - Никаких комментариев, только JSON
-        """
-
-        try:
-            resp = client.models.generate_content(
-                model=MODEL_ID,
-                contents=[
-                    types.Part.from_bytes(data=image_data, mime_type="image/jpeg"),
-                    prompt
-                ]
-            )
-        except Exception as e:
-            if "404" in str(e).lower() or "not found" in str(e).lower():
-                resp = client.models.generate_content(
-                    model="gemini-2.5-pro",
-                    contents=[
-                        types.Part.from_bytes(data=image_data, mime_type="image/jpeg"),
-                        prompt
-                    ]
-                )
-            else:
-                raise
-
-        text = (resp.text or "").strip()
+        image_data = bytes(await file.download_as_bytearray())
 
-        # извлекаем JSON
-        try:
-            data = extract_json(text)
-        except Exception:
-            await update.message.reply_text("❌ Не удалось извлечь позиции. Попробуйте другое фото.")
-            return
-
-        items = data.get("items", [])
-        if not items:
-            await update.message.reply_text("❌ Не удалось распознать позиции в чеке.")
-            return
+        # тот же снимок уже распознавали (повторная отправка) — OCR не зовём
+        image_key = hashlib.blake2b(image_data, digest_size=16).digest()
+        parsed = _receipt_cache.get(image_key)
+        if parsed is not None:
+            _receipt_cache.move_to_end(image_key)
+        else:
+            client = get_gemini_client()
+            # Part собираем один раз — его же переиспользует fallback на pro.
+            # Part.from_uri(file.file_path) не подходит: в URL файла Telegram зашит токен бота.
+            image_part = types.Part.from_bytes(data=image_data, mime_type="image/jpeg")
+            contents = [image_part, _RECEIPT_PROMPT]
 
-        conn = db.get_connection()
-        c = conn.cursor()
-        for item in items:
-            name = (item.get("name") or "").strip()
+            # асинхронный интерфейс SDK (client.aio): медленный OCR не блокирует event loop
             try:
-                price = float(item.get("price", 0) or 0)
-            except Exception:
-                price = 0.0
+                resp = await client.aio.models.generate_content(
+                    model=MODEL_ID,
+                    contents=contents
+                )
+            except Exception as e:
+                if "404" in str(e).lower() or "not found" in str(e).lower():
+                    resp = await client.aio.models.generate_content(
+                        model="gemini-2.5-pro",
+                        contents=contents
+                    )
+                else:
+                    raise
+
+            text = (resp.text or "").strip()
+
+            # извлекаем JSON
             try:
-                qty = int(item.get("quantity", 1) or 1)
+                data = extract_json(text)
             except Exception:
-                qty = 1
-            if not name or price <= 0:
-                continue
-
-            c.execute(
+                await update.message.reply_text("❌ Не удалось извлечь позиции. Попробуйте другое фото.")
+                return
+
+            items = data.get("items", [])
+            if not items:
+                await update.message.reply_text("❌ Не удалось распознать позиции в чеке.")
+                return
+
+            parsed = []
+            for item in items:
+                name = (item.get("name") or "").strip()
+                try:
+                    price = float(item.get("price", 0) or 0)
+                except Exception:
+                    price = 0.0
+                try:
+                    qty = int(item.get("quantity", 1) or 1)
+                except Exception:
+                    qty = 1
+                if not name or price <= 0:
+                    continue
+                parsed.append((name, price, qty))
+
+            # ни одна позиция не прошла проверку — не кешируем, пусть повторная отправка снова идёт в OCR
+            if not parsed:
+                await update.message.reply_text("❌ Не удалось распознать позиции в чеке.")
+                return
+
+            # кешируем уже проверенные позиции (кортеж — чтобы никто не изменил)
+            parsed = tuple(parsed)
+            _receipt_cache[image_key] = parsed
+            if len(_receipt_cache) > _RECEIPT_CACHE_SIZE:
+                _receipt_cache.popitem(last=False)
+
+        rows = [(session_id, name, price, qty) for name, price, qty in parsed]
+
+        # все позиции — одной пачкой в одной транзакции
+        with db.cursor() as c:
+            c.executemany(
                 "INSERT INTO resto_items (session_id, item_name, price, quantity) VALUES (?, ?, ?, ?)",
-                (session_id, name, price, qty)
+                rows
             )
 
-        conn.commit()
+            # состояние сессии для отрисовки — оно же кеш для нажатий на кнопки
+            state = load_resto_state(c, session_id)
 
+        context.chat_data[session_id] = state
         # соберём текст и клавиатуру с учётом текущего пользователя
-        msg, reply_markup, _creator_id = build_resto_ui(conn, session_id, user_id)
+        msg, reply_markup, _creator_id = build_resto_ui(state, user_id)
 
-        conn.close()
         await update.message.reply_text(msg, reply_markup=reply_markup)
 
     except Exception as e:
         logger.exception("Error processing receipt")
         await update.message.reply_text(f"❌ Ошибка при обработке чека: {e}")
-    finally:
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
 
 async def handle_item_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
@@ -523,23 +600,20 @@ async def handle_item_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Обработка закрытия счёта (кнопка внизу)
     if data == "close_resto":
         # проверим, что инициатор — создатель сессии
-        conn = db.get_connection(); c = conn.cursor()
         # по текущему сообщению находим последнюю открытую сессию в чате
         chat_id = q.message.chat.id
-        c.execute("SELECT id, creator_id FROM resto_sessions WHERE chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1", (chat_id,))
-        row = c.fetchone()
+        with db.cursor() as c:
+            c.execute("SELECT id, creator_id FROM resto_sessions WHERE chat_id = ? AND status = 'open' ORDER BY id DESC LIMIT 1", (chat_id,))
+            row = c.fetchone()
         if not row:
-            conn.close()
             await q.answer("Нет открытой сессии.", show_alert=True)
             return
         session_id, creator_id = row
         if user_id != creator_id:
-            conn.close()
             await q.answer("Только создатель может закрыть счёт.", show_alert=True)
             return
         # закрываем
-        chat_id = q.message.chat.id
-        await close_resto(update, context, session_id, conn, chat_id=chat_id)
+        await close_resto(update, context, session_id, chat_id=chat_id)
         return
 
     # Обработка выбора позиции
@@ -548,49 +622,51 @@ async def handle_item_choice(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     item_id = int(data.split("_")[1])
 
-    conn = db.get_connection()
-    c = conn.cursor()
+    with db.cursor() as c:
+        # Проверим статус сессии и заодно узнаем session_id для сборки UI
+        c.execute("""
+            SELECT rs.status, ri.session_id
+            FROM resto_sessions rs
+            JOIN resto_items ri ON rs.id = ri.session_id
+            WHERE ri.id = ?
+        """, (item_id,))
+        r = c.fetchone()
+        is_open = r is not None and r[0] == "open"
+
+        if is_open:
+            session_id = r[1]
+
+            # Тогглим выбор: DELETE по PK; если удалять было нечего — значит, выбираем
+            c.execute("DELETE FROM resto_choices WHERE item_id = ? AND user_id = ?", (item_id, user_id))
+            if c.rowcount == 0:
+                c.execute("INSERT INTO resto_choices (item_id, user_id, username) VALUES (?, ?, ?)",
+                          (item_id, user_id, q.from_user.username or q.from_user.first_name))
+                picked = True
+                picked_msg = "Вы выбрали блюдо"
+            else:
+                picked = False
+                picked_msg = "Выбор снят"
 
-    # Проверим статус сессии
-    c.execute("""
-        SELECT rs.id, rs.status
-        FROM resto_sessions rs
-        JOIN resto_items ri ON rs.id = ri.session_id
-        WHERE ri.id = ?
-    """, (item_id,))
-    r = c.fetchone()
-    if not r or r[1] != "open":
-        conn.close()
+    if not is_open:
         await q.answer("❌ Эта сессия уже закрыта.", show_alert=True)
         return
 
-    # Тогглим выбор: если уже выбран — снять; если не выбран — выбрать
-    c.execute("SELECT 1 FROM resto_choices WHERE item_id = ? AND user_id = ?", (item_id, user_id))
-    exists = c.fetchone() is not None
-    if exists:
-        c.execute("DELETE FROM resto_choices WHERE item_id = ? AND user_id = ?", (item_id, user_id))
-        picked_msg = "Выбор снят"
+    # Кеш трогаем только после успешного COMMIT — иначе он разойдётся с resto_choices.
+    # После рестарта кеша нет — читаем из БД (уже с этим выбором)
+    state = context.chat_data.get(session_id)
+    if state is None:
+        with db.cursor() as c:
+            state = load_resto_state(c, session_id)
+        context.chat_data[session_id] = state
+    elif picked:
+        state["choices"][item_id].add(user_id)
     else:
-        c.execute("INSERT INTO resto_choices (item_id, user_id, username) VALUES (?, ?, ?)",
-                  (item_id, user_id, q.from_user.username or q.from_user.first_name))
-        picked_msg = "Вы выбрали блюдо"
-
-    # Узнаем session_id для сборки UI
-    c.execute("SELECT session_id FROM resto_items WHERE id = ?", (item_id,))
-    session_id = c.fetchone()[0]
+        state["choices"][item_id].discard(user_id)
 
-    conn.commit()
-
-    # Пересоберём текст и клавиатуру, отметив текущего юзера
-    msg, markup, _creator_id = build_resto_ui(conn, session_id, user_id)
-    conn.close()
-
-    # Обновим сообщение (текст и клавиатуру)
-    try:
-        await q.edit_message_text(msg, reply_markup=markup)
-    except Exception:
-        # если редактировать текст нельзя (старые сообщения/правила TG), хотя бы клавиатуру
-        await q.edit_message_reply_markup(reply_markup=markup)
+    # Пересоберём клавиатуру, отметив текущего юзера. Текст от выборов не зависит,
+    # поэтому редактируем только клавиатуру
+    _msg, markup, _creator_id = build_resto_ui(state, user_id)
+    await q.edit_message_reply_markup(reply_markup=markup)
 
     await q.answer(picked_msg)
 
@@ -600,136 +676,155 @@ async def closebill(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
 
-    conn = db.get_connection()
-    c = conn.cursor()
-
-    c.execute("SELECT id, creator_id FROM bills WHERE chat_id = ? AND status = 'open'", (chat_id,))
-    bill_res = c.fetchone()
-
-    c.execute("SELECT id, creator_id FROM resto_sessions WHERE chat_id = ? AND status = 'open'", (chat_id,))
-    resto_res = c.fetchone()
+    # один запрос на оба вида открытых счетов; kind говорит, куда диспатчить
+    with db.cursor() as c:
+        c.execute("""
+            SELECT 'bill' AS kind, id, creator_id FROM bills
+             WHERE chat_id = ? AND status = 'open'
+            UNION ALL
+            SELECT 'resto', id, creator_id FROM resto_sessions
+             WHERE chat_id = ? AND status = 'open'
+        """, (chat_id, chat_id))
+        open_by_kind = {}
+        for kind, oid, creator_id in c.fetchall():
+            open_by_kind.setdefault(kind, (oid, creator_id))
+
+    bill_res = open_by_kind.get("bill")
+    resto_res = open_by_kind.get("resto")
 
     if bill_res:
         bill_id, creator_id = bill_res
         if user_id != creator_id:
             await update.message.reply_text("❌ Только создатель счета может его закрыть.")
-            conn.close()
             return
-        await close_newbill(update, context, bill_id, conn)
+        await close_newbill(update, context, bill_id)
         return
 
     if resto_res:
         session_id, creator_id = resto_res
         if user_id != creator_id:
             await update.message.reply_text("❌ Только создатель сессии может её закрыть.")
-            conn.close()
             return
-        await close_resto(update, context, session_id, conn)
+        await close_resto(update, context, session_id)
         return
 
-    conn.close()
     await update.message.reply_text("❌ Нет открытых счетов в этом чате.")
 
-async def close_newbill(update: Update, context: ContextTypes.DEFAULT_TYPE, bill_id: int, conn):
-    c = conn.cursor()
+async def close_newbill(update: Update, context: ContextTypes.DEFAULT_TYPE, bill_id: int):
+    # участники сразу с суммой своих трат (LEFT JOIN — чтобы не потерять тех, кто не платил)
+    with db.cursor() as c:
+        c.execute("""
+            SELECT bp.user_id, bp.username, COALESCE(SUM(e.amount), 0) AS paid, COUNT(e.id) AS n_expenses
+            FROM bill_participants bp
+            LEFT JOIN expenses e ON e.bill_id = bp.bill_id AND e.user_id = bp.user_id
+            WHERE bp.bill_id = ?
+            GROUP BY bp.id
+            ORDER BY bp.id
+        """, (bill_id,))
+        rows = c.fetchall()
+
+        participants = {}
+        user_paid = {}
+        total = 0.0
+        n_expenses = 0
+        for uid, name, paid, n in rows:
+            participants[uid] = name
+            user_paid[uid] = paid
+            total += paid
+            n_expenses += n
+
+        if participants and n_expenses:
+            c.execute("UPDATE bills SET status='closed', closed_at=? WHERE id=?", (datetime.now(), bill_id))
 
-    c.execute("SELECT user_id, username FROM bill_participants WHERE bill_id = ?", (bill_id,))
-    participants = {row[0]: row[1] for row in c.fetchall()}
     if not participants:
         await update.message.reply_text("❌ Нет участников в счете.")
-        conn.close()
         return
 
-    c.execute("SELECT user_id, amount FROM expenses WHERE bill_id = ?", (bill_id,))
-    expenses = c.fetchall()
-    if not expenses:
+    if not n_expenses:
         await update.message.reply_text("❌ Нет расходов для расчета.")
-        conn.close()
         return
 
-    total = sum(a for _, a in expenses)
     per_person = total / len(participants)
 
-    user_paid = {}
-    for uid, amt in expenses:
-        user_paid[uid] = user_paid.get(uid, 0) + amt
-
     balances = {uid: user_paid.get(uid, 0) - per_person for uid in participants}
     txs = minimize_transactions(balances)
 
-    msg = "💰 Счет закрыт!\n\n"
-    msg += f"Общая сумма: {total:,.0f} сум\nНа человека: {per_person:,.0f} сум\nУчастников: {len(participants)}\n\n"
-    msg += "📊 Расходы:\n"
+    parts = [
+        "💰 Счет закрыт!\n\n",
+        f"Общая сумма: {total:,.0f} сум\nНа человека: {per_person:,.0f} сум\nУчастников: {len(participants)}\n\n",
+        "📊 Расходы:\n",
+    ]
     for uid, name in participants.items():
-        msg += f"@{name}: {user_paid.get(uid, 0):,.0f} сум\n"
+        parts.append(f"@{name}: {user_paid.get(uid, 0):,.0f} сум\n")
 
-    msg += "\n💸 Расчеты:\n"
+    parts.append("\n💸 Расчеты:\n")
     if txs:
         for from_id, to_id, amount in txs:
-            msg += f"@{participants[from_id]} → @{participants[to_id]}: {amount:,.0f} сум\n"
+            parts.append(f"@{participants[from_id]} → @{participants[to_id]}: {amount:,.0f} сум\n")
     else:
-        msg += "Все уже расплатились! ✅\n"
+        parts.append("Все уже расплатились! ✅\n")
 
-    c.execute("UPDATE bills SET status='closed', closed_at=? WHERE id=?", (datetime.now(), bill_id))
-    conn.commit()
-    conn.close()
+    await update.message.reply_text("".join(parts))
 
-    await update.message.reply_text(msg)
+async def close_resto(update: Update, context: ContextTypes.DEFAULT_TYPE, session_id: int, chat_id: int | None = None):
 
-async def close_resto(update: Update, context: ContextTypes.DEFAULT_TYPE, session_id: int, conn, chat_id: int | None = None):
+    with db.cursor() as c:
+        c.execute("""
+            SELECT DISTINCT rc.user_id, rc.username
+            FROM resto_choices rc
+            JOIN resto_items ri ON rc.item_id = ri.id
+            WHERE ri.session_id = ?
+        """, (session_id,))
+        participants = {row[0]: row[1] for row in c.fetchall()}
+
+        c.execute("SELECT creator_id, creator_username FROM resto_sessions WHERE id = ?", (session_id,))
+        creator_id, creator_name = c.fetchone()
+        if creator_id not in participants:
+            participants[creator_id] = creator_name
+
+        if participants:
+            user_totals = {uid: 0.0 for uid in participants}
+
+            # доля каждого выбравшего по каждой позиции — одним запросом, без цикла по позициям
+            c.execute("""
+                SELECT rc.user_id,
+                       ri.price * ri.quantity * 1.0 / COUNT(*) OVER (PARTITION BY ri.id) AS split
+                FROM resto_items ri
+                JOIN resto_choices rc ON rc.item_id = ri.id
+                WHERE ri.session_id = ? AND NOT ri.is_shared
+            """, (session_id,))
+            for uid, split in c.fetchall():
+                user_totals[uid] += split
 
-    c = conn.cursor()
+            c.execute(
+                "SELECT COALESCE(SUM(price * quantity), 0) FROM resto_items WHERE session_id = ? AND is_shared",
+                (session_id,)
+            )
+            shared_total = c.fetchone()[0]
 
-    c.execute("""
-        SELECT DISTINCT rc.user_id, rc.username
-        FROM resto_choices rc
-        JOIN resto_items ri ON rc.item_id = ri.id
-        WHERE ri.session_id = ?
-    """, (session_id,))
-    participants = {row[0]: row[1] for row in c.fetchall()}
+            c.execute("UPDATE resto_sessions SET status='closed', closed_at=? WHERE id=?", (datetime.now(), session_id))
 
-    c.execute("SELECT creator_id, creator_username FROM resto_sessions WHERE id = ?", (session_id,))
-    creator_id, creator_name = c.fetchone()
-    if creator_id not in participants:
-        participants[creator_id] = creator_name
+    # сессия закрыта — кеш её клавиатуры больше не нужен
+    context.chat_data.pop(session_id, None)
 
     if not participants:
         await update.message.reply_text("❌ Никто не выбрал блюда.")
-        conn.close()
         return
 
-    user_totals = {uid: 0.0 for uid in participants}
-    c.execute("SELECT id, item_name, price, quantity, is_shared FROM resto_items WHERE session_id = ?", (session_id,))
-    items = c.fetchall()
-
-    shared_total = 0.0
-    for item_id, name, price, qty, is_shared in items:
-        total_price = price * qty
-        if is_shared:
-            shared_total += total_price
-        else:
-            c.execute("SELECT user_id FROM resto_choices WHERE item_id = ?", (item_id,))
-            choosers = [row[0] for row in c.fetchall()]
-            if choosers:
-                split = total_price / len(choosers)
-                for uid in choosers:
-                    user_totals[uid] += split
-
     if shared_total > 0:
         per_person = shared_total / len(participants)
         for uid in participants:
             user_totals[uid] += per_person
 
     total = sum(user_totals.values())
-    msg = "🍽 Чек из ресторана разделен!\n\n"
-    msg += f"Общая сумма: {total:,.0f} сум\nУчастников: {len(participants)}\n\n"
-    msg += "💰 К оплате:\n"
+    parts = [
+        "🍽 Чек из ресторана разделен!\n\n",
+        f"Общая сумма: {total:,.0f} сум\nУчастников: {len(participants)}\n\n",
+        "💰 К оплате:\n",
+    ]
     for uid, name in participants.items():
-        msg += f"@{name}: {user_totals[uid]:,.0f} сум\n"
-
-    c.execute("UPDATE resto_sessions SET status='closed', closed_at=? WHERE id=?", (datetime.now(), session_id))
-    conn.commit()
-    conn.close()
+        parts.append(f"@{name}: {user_totals[uid]:,.0f} сум\n")
+    msg = "".join(parts)
 
     if chat_id is None:
         # попробуем вытащить из update, если это не callback
@@ -751,46 +846,51 @@ async def close_resto(update: Update, context: ContextTypes.DEFAULT_TYPE, sessio
 async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
-    conn = db.get_connection()
-    c = conn.cursor()
+    # последние 10 каждого вида за один запрос; обе ветки идут по индексам (chat_id, created_at).
+    # Порядок внутренних подзапросов UNION ALL не сохраняет — сортируем явно
+    with db.cursor() as c:
+        c.execute("""
+            SELECT * FROM (
+                SELECT 'bill' AS kind, id, creator_username, created_at, closed_at, status
+                FROM bills
+                WHERE chat_id = ?
+                ORDER BY created_at DESC
+                LIMIT 10
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT 'resto', id, creator_username, created_at, closed_at, status
+                FROM resto_sessions
+                WHERE chat_id = ?
+                ORDER BY created_at DESC
+                LIMIT 10
+            )
+            ORDER BY kind, created_at DESC
+        """, (chat_id, chat_id))
+        rows = c.fetchall()
 
-    c.execute("""
-        SELECT id, creator_username, created_at, closed_at, status
-        FROM bills
-        WHERE chat_id = ?
-        ORDER BY created_at DESC
-        LIMIT 10
-    """, (chat_id,))
-    bills = c.fetchall()
+    bills = [row[1:] for row in rows if row[0] == "bill"]
+    restos = [row[1:] for row in rows if row[0] == "resto"]
 
-    c.execute("""
-        SELECT id, creator_username, created_at, closed_at, status
-        FROM resto_sessions
-        WHERE chat_id = ?
-        ORDER BY created_at DESC
-        LIMIT 10
-    """, (chat_id,))
-    restos = c.fetchall()
-
-    msg = "📜 История:\n\n"
+    parts = ["📜 История:\n\n"]
     if bills:
-        msg += "💰 /newbill:\n"
+        parts.append("💰 /newbill:\n")
         for bid, creator, created, closed, status in bills:
             emoji = "✅" if status == "closed" else "🔓"
             # created может быть строкой — не парсим, просто показываем
-            msg += f"{emoji} #{bid} — @{creator} ({created})\n"
-        msg += "\n"
+            parts.append(f"{emoji} #{bid} — @{creator} ({created})\n")
+        parts.append("\n")
 
     if restos:
-        msg += "🍽 /resto:\n"
+        parts.append("🍽 /resto:\n")
         for sid, creator, created, closed, status in restos:
             emoji = "✅" if status == "closed" else "🔓"
-            msg += f"{emoji} #{sid} — @{creator} ({created})\n"
+            parts.append(f"{emoji} #{sid} — @{creator} ({created})\n")
 
+    msg = "".join(parts)
     if not bills and not restos:
         msg = "📜 История пуста. Создайте первый счёт с помощью /newbill или /resto."
 
-    conn.close()
     await update.message.reply_text(msg)
 
    